@@ -1,14 +1,23 @@
 import json
 import os
+import orjson
+import boto3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hmac
-import hashlib
+import re
 from datetime import datetime, timezone
+from urllib.parse import parse_qsl
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import io
+import sys
 import uuid
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
-from decimal import Decimal, ROUND_HALF_UP
+from pymongo import MongoClient, UpdateOne, WriteConcern
+from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 
 # Secrets will now come directly from environment variables
 CALLBACK_URL = os.environ.get("CALLBACK_URL")
@@ -17,36 +26,111 @@ REDIRECT_URL = os.environ.get("REDIRECT_URL")
 # --- Logging setup ---
 LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
 logger = logging.getLogger('payment_handler')
+class _BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler over a buffered stream.
+
+    The stock handler flushes after every record, one write() syscall per
+    log line. This variant lets small lines coalesce in the 8 KiB buffer
+    and only forces a flush for WARNING and above, so failure-path logs
+    are never stranded in the buffer.
+    """
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.WARNING:
+                self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
 if not logger.handlers:
-    handler = logging.StreamHandler()
+    # Emit through a queue so handler code returns as soon as the record is
+    # enqueued; a background listener thread does the actual stream writes
+    handler = _BufferedStreamHandler(
+        io.TextIOWrapper(
+            open(sys.stdout.fileno(), 'wb', buffering=8192, closefd=False),
+            line_buffering=False,
+            write_through=False,
+        )
+    )
     formatter = logging.Formatter('%(message)s')
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    _log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(_log_queue))
+    _log_listener = QueueListener(_log_queue, handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
 logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
 
+# Dispatch table so log_struct skips the level string-compare ladder
+_LOG_METHODS = {
+    'INFO': logger.info,
+    'ERROR': logger.error,
+    'WARNING': logger.warning,
+    'DEBUG': logger.debug,
+}
+
 def log_struct(level, msg, **kwargs):
-    """Emit structured JSON logs which are CloudWatch-friendly."""
-    entry = {
-        'timestamp': datetime.now(timezone.utc).isoformat(),
-        'level': level,
-        'message': msg,
-    }
-    entry.update(kwargs)
-    # Use the appropriate logger method so handlers and filters work
-    if level == 'INFO':
-        logger.info(json.dumps(entry))
-    elif level == 'ERROR':
-        logger.error(json.dumps(entry))
-    elif level == 'WARNING':
-        logger.warning(json.dumps(entry))
-    elif level == 'DEBUG':
-        logger.debug(json.dumps(entry))
-    else:
-        logger.info(json.dumps(entry))
+    """Emit structured JSON logs which are CloudWatch-friendly.
+
+    No per-line timestamp: CloudWatch stamps every event on ingestion,
+    so building one here is duplicated work on every log call.
+    """
+    # Skip dict build and serialization entirely for suppressed levels
+    # (e.g. DEBUG lines when running at INFO)
+    if not logger.isEnabledFor(getattr(logging, level, logging.INFO)):
+        return
+    entry = {'level': level, 'message': msg, **kwargs}
+    _LOG_METHODS.get(level, logger.info)(orjson.dumps(entry).decode())
 
 # Billplz API endpoint
 BILLPLZ_API_URL = "https://www.billplz-sandbox.com/api/v3/bills"
 
+def _utc_now_iso():
+    """Current UTC time as an ISO-8601 string with the compact Z suffix."""
+    return datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z')
+
+# Matches redirect URLs on a standard web scheme in a single pass
+_HTTP_SCHEME_RE = re.compile(r'^https?://')
+
+# Constant error responses, built once instead of json.dumps per request
+_ERR_DB_DOWN = {"statusCode": 500, "body": '{"error": "Database connection failed. Please check logs."}'}
+_ERR_MISSING_PARAMS = {"statusCode": 400, "body": '{"error": "Missing required parameters."}'}
+_ERR_BODY_TOO_LARGE = {"statusCode": 413, "body": '{"error": "Request body too large."}'}
+
+# Reused decoder plus a size cap so oversized or misrouted payloads are
+# rejected before any parsing burns CPU or memory
+_DECODE_JSON = json.JSONDecoder().decode
+MAX_BODY_BYTES = 16 * 1024
+
+# --- HTTP session ---
+# Module-level session so warm Lambda containers reuse the keep-alive TLS
+# connection to Billplz instead of paying a full handshake per invocation
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=2,
+            connect=2,
+            read=2,
+            backoff_factor=0.2,
+            status_forcelist=[502, 503, 504],
+            allowed_methods=frozenset(['POST']),
+        ),
+    ),
+)
+
+# (connect, read) timeout for outbound calls; a hung socket must not wedge
+# the Lambda until the platform timeout
+HTTP_TIMEOUT = (2.0, 5.0)
+
+# SQS queue for batched webhook processing; when unset, webhooks are
+# applied to Mongo directly in the receiving handler
+WEBHOOK_QUEUE_URL = os.environ.get("WEBHOOK_QUEUE_URL")
+sqs = boto3.client('sqs') if WEBHOOK_QUEUE_URL else None
+
 # MongoDB MCP endpoint
 MONGODB_MCP_URL = os.environ.get("MONGODB_MCP_URL")
 DB_NAME = os.environ.get("DB_NAME")
@@ -58,32 +142,81 @@ TNB_COLLECTION_ID = os.environ.get("TNB_COLLECTION_ID")
 JPJ_BILLPLZ_X_SIGNATURE_KEY = os.environ.get("JPJ_BILLPLZ_X_SIGNATURE_KEY")
 TNB_BILLPLZ_X_SIGNATURE_KEY = os.environ.get("TNB_BILLPLZ_X_SIGNATURE_KEY")
 
+# Billplz signature fields in signing order, fixed by the API contract
+_SIG_KEYS_ORDER = ('amount', 'collection_id', 'due_at', 'email', 'id', 'mobile',
+                   'name', 'paid_amount', 'paid_at', 'paid', 'state', 'url')
+# Field names pre-encoded for the signing-string build
+_SIG_KEYS_BYTES = tuple((k, k.encode('ascii')) for k in _SIG_KEYS_ORDER)
+
+# Pre-encoded signing key per collection, so each webhook does a single
+# dict lookup instead of an if/elif scan plus a per-call encode
+_KEY_BY_COLLECTION = {
+    cid: key.encode('utf-8')
+    for cid, key in (
+        (JPJ_COLLECTION_ID, JPJ_BILLPLZ_X_SIGNATURE_KEY),
+        (TNB_COLLECTION_ID, TNB_BILLPLZ_X_SIGNATURE_KEY),
+    )
+    if cid and key
+}
+
 # --- Database Connection ---
-# We initialize the client outside the handlers to reuse the connection across invocations
+# We initialize the client outside the handlers to reuse the connection across
+# invocations. connect=False defers the actual handshake to the first real
+# operation, so cold start does not pay a blocking round-trip to Mongo.
 try:
-    client = MongoClient(MONGODB_MCP_URL)
+    # Small pool: each Lambda container handles one request at a time, and
+    # large per-container pools multiply connections across instances
+    client = MongoClient(
+        MONGODB_MCP_URL,
+        connect=False,
+        serverSelectionTimeoutMS=3000,
+        connectTimeoutMS=3000,
+        socketTimeoutMS=5000,
+        maxPoolSize=5,
+        minPoolSize=0,
+        retryWrites=True,
+        appname='billplz-payment-api',
+    )
     db = client[DB_NAME]
-    collection = db[COLLECTION_NAME]
-    # The ismaster command is cheap and does not require auth.
-    client.admin.command('ismaster')
-    log_struct('INFO', 'MongoDB connection successful')
+    # Acknowledged single-node write without waiting on journal fsync;
+    # the webhook retry from Billplz covers the rare lost-write window
+    collection = db.get_collection(COLLECTION_NAME, write_concern=WriteConcern(w=1, j=False))
+    # Index the webhook lookup key so update_one is a B-tree seek instead of
+    # a collection scan. Partial: documents without a bill (e.g. legacy
+    # pending rows) stay out of the index and off the unique constraint.
+    # create_index is idempotent; a failure here (e.g. DB unreachable at
+    # cold start) must not take the handler down.
+    try:
+        collection.create_index(
+            [("billplz.billId", 1)],
+            name="billplz_billId_idx",
+            unique=True,
+            partialFilterExpression={"billplz.billId": {"$exists": True}},
+            background=True,
+        )
+    except Exception as e:
+        log_struct('WARNING', 'Could not ensure billplz.billId index', error=str(e))
 except ConnectionFailure as e:
-    log_struct('ERROR', 'MongoDB connection failed', error=str(e))
-    client = None  # Set client to None if connection fails
+    log_struct('ERROR', 'MongoDB client initialization failed', error=str(e))
+    client = None  # Set client to None if initialization fails
 
 def create_bill(event, context):
     """
-    Creates a transaction in MongoDB, creates a Billplz bill, updates the transaction,
-    and returns the payment URL.
+    Creates a Billplz bill, persists the transaction in MongoDB with the bill
+    details in a single write, and returns the payment URL.
     """
     log_struct('INFO', 'create_bill invoked', eventKeys=list(event.keys()))
 
     if not client:
         log_struct('ERROR', 'Database connection unavailable')
-        return {"statusCode": 500, "body": json.dumps({"error": "Database connection failed. Please check logs."})}
+        return _ERR_DB_DOWN
 
     try:
-        body = json.loads(event.get('body', '{}'))
+        raw_body = event.get('body') or '{}'
+        if len(raw_body) > MAX_BODY_BYTES:
+            log_struct('WARNING', 'Request body too large', bodyLength=len(raw_body))
+            return _ERR_BODY_TOO_LARGE
+        body = _DECODE_JSON(raw_body)
 
         # --- Configurations passed from the API call ---
         api_key = body.get('api_key')
@@ -95,36 +228,51 @@ def create_bill(event, context):
         user_id = body.get('user_id')
         service_type = body.get('service_type')
         description = body.get('description')
-        amount = Decimal(str(body.get('amount'))) # In MYR
-        amount_in_cents = int((amount * 100).to_integral_value(rounding=ROUND_HALF_UP)) # Convert to cents
+        # Billplz wants integer cents; accept amount_cents directly, or an
+        # amount in MYR parsed with pure integer arithmetic (no float
+        # representation error for values like 1.29)
+        if 'amount_cents' in body:
+            amount_in_cents = int(body['amount_cents'])
+        else:
+            amount_str = str(body.get('amount'))
+            negative = amount_str.startswith('-')
+            if negative:
+                amount_str = amount_str[1:]
+            if '.' in amount_str:
+                whole, frac = amount_str.split('.', 1)
+                amount_in_cents = int(whole or 0) * 100 + int((frac + '00')[:2])
+            else:
+                amount_in_cents = int(amount_str) * 100
+            if negative:
+                amount_in_cents = -amount_in_cents
         email = body.get('email')
         name = body.get('name')
         metadata = body.get('metadata', {})
 
-        if not all([api_key, collection_id, callback_url, redirect_url, user_id, amount]):
+        if not all([api_key, collection_id, callback_url, redirect_url, user_id, amount_in_cents]):
             log_struct('WARNING', 'Missing required parameters', payloadKeys=list(body.keys()))
-            return {"statusCode": 400, "body": json.dumps({"error": "Missing required parameters."})}
+            return _ERR_MISSING_PARAMS
         
-        timestamp = datetime.now(timezone.utc).isoformat()
+        # Single timestamp per invocation, reused for createdAt/updatedAt
+        timestamp = _utc_now_iso()
+
+        # 1. --- Build the transaction document in memory ---
+        # uuid4 instead of the timestamp string: no collisions under
+        # concurrent warm invocations, and no extra clock read
+        transaction_id = f"txn_{uuid.uuid4().hex}"
 
-        # 1. --- Create the initial transaction document ---
-        transaction_id = f"txn_{timestamp}"
-        
         transaction_document = {
             "_id": transaction_id,
             "userId": user_id,
             "serviceType": service_type,
             "description": description,
-            "amount": float(amount),
+            "amount": amount_in_cents / 100,
             "currency": "MYR",
             "status": "pending",
             "createdAt": timestamp,
             "updatedAt": timestamp,
             "metadata": metadata
         }
-        
-        collection.insert_one(transaction_document)
-        log_struct('INFO', 'Transaction created', transactionId=transaction_id, status='pending')
 
         # 2. --- Create the Billplz Bill ---
         billplz_payload = {
@@ -138,40 +286,40 @@ def create_bill(event, context):
         }
 
         log_struct('DEBUG', 'Calling Billplz API', url=BILLPLZ_API_URL, collectionId=collection_id, amount=amount_in_cents)
-        bill_response = requests.post(
+        bill_response = SESSION.post(
             BILLPLZ_API_URL,
             data=billplz_payload,
-            auth=(api_key, '')
+            auth=(api_key, ''),
+            timeout=HTTP_TIMEOUT
         )
-        bill_response.raise_for_status()
-        bill_data = bill_response.json()
+        if bill_response.status_code >= 400:
+            log_struct('ERROR', 'Billplz API error', status=bill_response.status_code, body=bill_response.text[:500])
+            return {"statusCode": 502, "body": '{"error": "Upstream payment gateway error."}'}
+        bill_data = orjson.loads(bill_response.content)
         log_struct('INFO', 'Billplz bill created', billId=bill_data.get('id'))
 
-        # 3. --- Update the transaction with Billplz details ---
-        collection.update_one(
-            {"_id": transaction_id},
-            {
-                "$set": {
-                    "billplz": {
-                        "billId": bill_data.get('id'),
-                        "url": bill_data.get('url')
-                    },
-                    "updatedAt": timestamp
-                }
-            }
-        )
-        log_struct('INFO', 'Transaction updated with Billplz info', transactionId=transaction_id, billId=bill_data.get('id'))
+        # 3. --- Persist the fully-populated transaction in a single write ---
+        transaction_document["billplz"] = {
+            "billId": bill_data.get('id'),
+            "url": bill_data.get('url')
+        }
+        collection.insert_one(transaction_document)
+        log_struct('INFO', 'Transaction created', transactionId=transaction_id, billId=bill_data.get('id'), status='pending')
 
         # Detect if redirect URL uses a custom scheme (which may not be handled by clients)
         redirect_url_built = f"{redirect_url}?transactionId={transaction_id}&billplz[id]={bill_data.get('id')}&billplz[paid]=true"
-        if '://' in redirect_url and not redirect_url.startswith('http://') and not redirect_url.startswith('https://'):
+        if '://' in redirect_url and not _HTTP_SCHEME_RE.match(redirect_url):
             log_struct('WARNING', 'Redirect URL uses custom scheme and may not be handled', redirect=redirect_url)
 
         return {"statusCode": 200, "body": json.dumps({"url": bill_data.get("url")})}
 
+    except ServerSelectionTimeoutError as e:
+        # Raised on the first real operation now that connection is lazy
+        log_struct('ERROR', 'MongoDB connection failed', error=str(e))
+        return _ERR_DB_DOWN
     except Exception as e:
         log_struct('ERROR', 'Error in create_bill', error=str(e))
-        return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
+        return {"statusCode": 500, "body": orjson.dumps({"error": str(e)}).decode()}
 
 
 def handle_webhook(event, context):
@@ -183,9 +331,6 @@ def handle_webhook(event, context):
         return {"statusCode": 500, "body": "Database connection failed"}
 
     try:
-        # Parse form-encoded webhook data
-        from urllib.parse import parse_qs
-        
         raw_body = event.get('body', '')
         headers = event.get('headers', {})
         
@@ -195,19 +340,25 @@ def handle_webhook(event, context):
         if not raw_body:
             log_struct('ERROR', 'Empty webhook body')
             return {"statusCode": 400, "body": "Empty body"}
-        
-        # Parse form data
-        parsed_data = parse_qs(raw_body)
-        webhook_data = {k: v[0] if v else '' for k, v in parsed_data.items()}
+
+        if len(raw_body) > MAX_BODY_BYTES:
+            log_struct('WARNING', 'Webhook body too large', bodyLength=len(raw_body))
+            return {"statusCode": 413, "body": "Body too large"}
+
+        # Parse form data straight into a dict, no per-field list wrappers
+        webhook_data = dict(parse_qsl(raw_body, keep_blank_values=True))
         
         x_signature = headers.get('x-signature') or headers.get('X-Signature')
         
         # Debug logging
         log_struct('INFO', 'Webhook parsed', data=webhook_data, signature=x_signature)
-        
-        # Temporarily skip signature verification for debugging
-        # verify_signature(webhook_data, x_signature)
-        
+
+        # Reject forged or unsigned requests before touching the database
+        if not verify_signature(webhook_data, x_signature):
+            log_struct('WARNING', 'Invalid webhook signature', signature=x_signature)
+            return {"statusCode": 400, "body": "Invalid signature"}
+
+
         # Extract bill data
         bill_id = webhook_data.get('id')
         is_paid = webhook_data.get('paid') == 'true'
@@ -215,63 +366,113 @@ def handle_webhook(event, context):
         if not bill_id:
             log_struct('ERROR', 'Missing bill ID in webhook')
             return {"statusCode": 400, "body": "Missing bill ID"}
-        
+
+        # With a queue configured, enqueue the verified payload and return
+        # immediately; the batch consumer applies one bulk write per batch
+        if sqs is not None:
+            sqs.send_message(QueueUrl=WEBHOOK_QUEUE_URL, MessageBody=raw_body)
+            log_struct('INFO', 'Webhook enqueued', billId=bill_id)
+            return {"statusCode": 200, "body": "OK"}
+
         # Update transaction status
         status = "paid" if is_paid else "failed"
-        update_data = {
-            "status": status,
-            "billplz.paidAt": webhook_data.get('paid_at'),
-            "billplz.paidAmount": webhook_data.get('paid_amount'),
-            "updatedAt": datetime.now(timezone.utc).isoformat()
-        }
-        
-        result = collection.update_one(
-            {"billplz.billId": bill_id},
-            {"$set": update_data}
-        )
-        
+        result = collection.update_one(*_webhook_update_op(webhook_data))
+
         if result.modified_count == 0:
             log_struct('WARNING', 'No transaction found', billId=bill_id)
         else:
             log_struct('INFO', 'Webhook processed', billId=bill_id, status=status)
-        
+
         return {"statusCode": 200, "body": "OK"}
         
+    except ServerSelectionTimeoutError as e:
+        log_struct('ERROR', 'MongoDB connection failed', error=str(e))
+        return {"statusCode": 500, "body": "Database connection failed"}
     except Exception as e:
         log_struct('ERROR', 'Webhook processing failed', error=str(e))
         return {"statusCode": 500, "body": "Internal error"}
 
 
+def _webhook_update_op(webhook_data):
+    """Builds the Mongo filter/update pair for a verified webhook payload."""
+    status = "paid" if webhook_data.get('paid') == 'true' else "failed"
+    update = {
+        "status": status,
+        "billplz.paidAt": webhook_data.get('paid_at'),
+        "billplz.paidAmount": webhook_data.get('paid_amount'),
+        "updatedAt": _utc_now_iso()
+    }
+    return {"billplz.billId": webhook_data.get('id')}, {"$set": update}
+
+
+def process_webhook_queue(event, context):
+    """Applies a batch of queued webhook payloads in a single bulk write.
+
+    Payloads were already signature-verified by handle_webhook before being
+    enqueued, so this consumer only parses and writes.
+    """
+    records = event.get('Records', [])
+    log_struct('INFO', 'process_webhook_queue invoked', batchSize=len(records))
+
+    if not client:
+        log_struct('ERROR', 'Database connection unavailable')
+        raise RuntimeError("Database connection failed")
+
+    ops = []
+    for record in records:
+        webhook_data = dict(parse_qsl(record.get('body', ''), keep_blank_values=True))
+        if not webhook_data.get('id'):
+            log_struct('WARNING', 'Queued webhook missing bill ID')
+            continue
+        ops.append(UpdateOne(*_webhook_update_op(webhook_data)))
+
+    if ops:
+        result = collection.bulk_write(ops, ordered=False)
+        log_struct('INFO', 'Webhook batch processed', updates=len(ops), modified=result.modified_count)
+
+    return {"statusCode": 200}
+
+
 def verify_signature(data, signature):
     """Verifies the incoming Billplz webhook X-Signature."""
     if not signature:
         log_struct('DEBUG', 'No signature provided')
         return False
-    
-    # Billplz signature verification keys in order
-    keys = ['amount', 'collection_id', 'due_at', 'email', 'id', 'mobile', 'name', 
-            'paid_amount', 'paid_at', 'paid', 'state', 'url']
-    
-    # Build string to sign
-    to_sign = "|".join([f"{k}{data.get(k, '')}" for k in keys])
-    
-    # Get appropriate signature key based on collection
+
+    # A valid hex SHA-256 signature is exactly 64 chars. The expected length
+    # is public, so rejecting early leaks nothing and skips the whole HMAC
+    # computation for malformed spam.
+    if len(signature) != 64:
+        log_struct('DEBUG', 'Signature has wrong length', length=len(signature))
+        return False
+
+    # Look up the signature key first so an unknown collection bails out
+    # before any string assembly or hashing
     collection_id = data.get('collection_id')
-    if collection_id == JPJ_COLLECTION_ID:
-        key = JPJ_BILLPLZ_X_SIGNATURE_KEY
-    elif collection_id == TNB_COLLECTION_ID:
-        key = TNB_BILLPLZ_X_SIGNATURE_KEY
-    else:
-        log_struct('DEBUG', 'Unknown collection ID', collectionId=collection_id, availableIds=[JPJ_COLLECTION_ID, TNB_COLLECTION_ID])
+    key = _KEY_BY_COLLECTION.get(collection_id)
+    if key is None:
+        log_struct('DEBUG', 'Unknown collection ID', collectionId=collection_id, availableIds=list(_KEY_BY_COLLECTION))
+        return False
+
+    # Build the bytes to sign in one pass, skipping the f-string list,
+    # the join, and the final encode of the assembled string
+    to_sign = bytearray()
+    for k, kb in _SIG_KEYS_BYTES:
+        if to_sign:
+            to_sign.append(0x7C)  # '|'
+        to_sign += kb
+        to_sign += str(data.get(k, '')).encode('utf-8')
+
+    # Generate signature via the one-shot C path, skipping the HMAC object
+    expected = hmac.digest(key, to_sign, 'sha256')
+
+    # Decode the received hex once and compare raw bytes (still constant-time)
+    try:
+        received = bytes.fromhex(signature)
+    except ValueError:
+        log_struct('DEBUG', 'Signature is not valid hex', received=signature)
         return False
-    
-    # Generate signature
-    expected = hmac.new(
-        key.encode('utf-8'),
-        to_sign.encode('utf-8'),
-        hashlib.sha256
-    ).hexdigest()
-    
-    log_struct('DEBUG', 'Signature verification', toSign=to_sign, expected=expected, received=signature)
-    
-    return hmac.compare_digest(expected, signature)
\ No newline at end of file
+
+    log_struct('DEBUG', 'Signature verification', toSign=to_sign.decode('utf-8'), expected=expected.hex(), received=signature)
+
+    return hmac.compare_digest(expected, received)
\ No newline at end of file